@@ -14,6 +14,13 @@ import asyncio, os, json, time
 from datetime import datetime
 from aiohttp import web
 
+# 安装了uvloop时使用基于libuv的事件循环，连接较多的异步io更快
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
 
 def index(request):
     return web.Response(body=b'<h1>Awesome</h1>', content_type='text/html')
@@ -6,7 +6,7 @@ __author__ = 'liuyizhen'
 '''
 选择mysql作为网站后台数据库
 执行sql语句进行操作，并将常用的select、insert、update等语句进行函数封装
-在异步框架（aiohttp）的基础上，采用aiomysql作为数据库的异步io驱动
+在异步框架（aiohttp）的基础上，采用asyncmy（未安装时使用aiomysql）作为数据库的异步io驱动
 在数据库中表的操作，映射成一个类的操作，也就是数据库表的一行映射成一个队员（orm）
 整个orm也是异步操作
 一层异步，层层异步
@@ -21,38 +21,65 @@ tips：
     1、调用user.save()并没有效果，因为调用save()仅仅是创建了一个协程，并未执行它。 需要调用 yield from user.save()才是执行了insert操作
 '''
 
-import asyncio, logging
-import aiohttp, aiomysql, sys
+import asyncio, logging, functools, time
+from contextlib import asynccontextmanager
+from collections import OrderedDict
+
+# 优先使用Cython实现的asyncmy驱动，协议解析更快；未安装时使用纯python的aiomysql，两者接口基本一致
+try:
+    import asyncmy as driver
+    from asyncmy import cursors, errors
+except ImportError:
+    import aiomysql as driver
+    cursors = errors = driver
+
+# 使用模块自己的logger，日志参数延迟格式化，日志级别关闭时不做字符串拼接
+logger = logging.getLogger(__name__)
 
 
 # 打印sql查询语句
 def log(sql, args=()):
-    logging.info('SQL: %s' % sql)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info('SQL: %s', sql)
 
 
 # 创建一个全局的连接池，每个http请求都从连接池中获取数据库连接。 **kw参数可以包含所有连接需要用到的关键字参数 "key"="value"
 async def create_pool(loop, **kw):
-    logging.info('create database connection pool...')
+    logger.info('create database connection pool...')
 
     # 全局变量__pool用于存储整个连接池
     global __pool
 
+    # asyncio（以及uvloop）的TCP连接默认开启TCP_NODELAY，小查询不会被Nagle算法延迟，无需另外设置
     # dict有一个get方法，如果dict中有对应的value值，则返回对应于key的value值，否则返回默认值，即host中的'localhost'
-    __pool = await aiomysql.create_pool(
+    # 默认最大连接数为50，最小为10，启动时就预先建立好连接；只指定了较小的maxsize时，minsize不超过maxsize
+    # maxsize建议设置为worker数的2倍左右，并且不要超过mysql的max_connections
+    maxsize = kw.get('maxsize', 50)
+    minsize = kw.get('minsize', min(10, maxsize))
+    poolKw = dict(
         # 默认本机ip
         host=kw.get('host', 'localhost'),
         user=kw['user'],
-        passowrd=kw['password'],
-        db=kw['db'],
+        password=kw['password'],
         port=kw.get('port', 3306),
         charset=kw.get('charset', 'utf8'),
         autocommit=kw.get('autocommit', True),
-        # 默认最大连接数为10，最小为1
-        maxsize=kw.get('maxsize', 10),
-        minsize=kw.get('minsize', 1),
-        # 接收一个event_loop实例
-        loop=loop
+        maxsize=maxsize,
+        minsize=minsize,
+        # 空闲超过半小时的连接会被回收重建，避免被mysql的wait_timeout断开（云数据库的wait_timeout通常更短）
+        pool_recycle=kw.get('pool_recycle', 1800),
     )
+    if driver.__name__ == 'asyncmy':
+        poolKw['database'] = kw['db']
+    else:
+        poolKw['db'] = kw['db']
+        # 接收一个event_loop实例
+        poolKw['loop'] = loop
+    __pool = await driver.create_pool(**poolKw)
+
+    # 连接空闲超过ping_idle秒时，取出后先ping一次；wait_timeout较短的云数据库可以和pool_recycle一起调小
+    global __ping_idle
+    __ping_idle = kw.get('ping_idle', PING_IDLE_SECONDS)
 
 
 async def destroy_pool():
@@ -62,26 +89,99 @@ async def destroy_pool():
         await  __pool.wait_closed()
 
 
+# 连接空闲超过该秒数时，取出后先ping一次，断开的连接会自动重连
+# 默认值，可通过create_pool的ping_idle参数修改
+PING_IDLE_SECONDS = 60
+__ping_idle = PING_IDLE_SECONDS
+# 表示连接已断开的mysql错误码：2006 MySQL server has gone away，2013 Lost connection to MySQL server
+CR_SERVER_GONE_ERROR = 2006
+LOST_CONNECTION_ERRORS = (CR_SERVER_GONE_ERROR, 2013)
+
+
+def is_lost_connection(e):
+    if isinstance(e, errors.InterfaceError):
+        return True
+    return isinstance(e, errors.OperationalError) and bool(e.args) and e.args[0] in LOST_CONNECTION_ERRORS
+
+
+# 2006表示发送语句时连接已经断开，语句没有到达服务端
+def is_server_gone(e):
+    return isinstance(e, errors.OperationalError) and bool(e.args) and e.args[0] == CR_SERVER_GONE_ERROR
+
+
+# 从连接池中取出一个连接
+# 发生连接错误时关闭该连接，不再放回连接池，下次会取到新的连接
+@asynccontextmanager
+async def connection():
+    async with __pool.acquire() as conn:
+        # 从未使用过的连接（如create_pool预先建立的minsize个连接）也可能已被服务端断开，第一次取出时同样先ping
+        if time.monotonic() - getattr(conn, '_last_used', 0) > __ping_idle:
+            await conn.ping(reconnect=True)
+        try:
+            yield conn
+        except (errors.OperationalError, errors.InterfaceError) as e:
+            if is_lost_connection(e):
+                conn.close()
+            raise
+        finally:
+            conn._last_used = time.monotonic()
+
+
 # 封装sql select语句为select函数
-async def select(sql, args, size=None):
+# sql语句需使用mysql的占位符%s
+# cursorclass默认为DictCursor，每行返回一个dict
+async def select(sql, args, size=None, cursorclass=cursors.DictCursor):
     log(sql, args)
     global __pool
 
-    # yield from (await)将调用一个子协程，并直接返回调用的结果
-    # 从连接池中返回一个连接
-    async with __pool.get() as conn:
-        # DictCurosr is a cursor which returns results as a dictionary
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            # 执行sql语句，sql语句占位符为？，mysql占位符为%s
-            await cur.execute(sql.replace('?', '%s'), args or ())
-            # 返回全部数据或指定数据量
-            if size:
-                res = await cur.fetchmany(size)
-            else:
-                res = await  cur.fetchall()
+    # 连接已断开时（如被mysql的wait_timeout关闭）换一个连接重试一次
+    for retry in (True, False):
+        try:
+            # yield from (await)将调用一个子协程，并直接返回调用的结果
+            # 从连接池中返回一个连接
+            async with connection() as conn:
+                # DictCurosr is a cursor which returns results as a dictionary
+                async with conn.cursor(cursorclass) as cur:
+                    # 执行sql语句，传入的sql已使用mysql的占位符%s（由ModelMetaClass预先转换）
+                    await cur.execute(sql, args or ())
+                    # 返回全部数据或指定数据量
+                    if size:
+                        res = await cur.fetchmany(size)
+                    else:
+                        res = await  cur.fetchall()
+
+                    if logger.isEnabledFor(logging.INFO):
+                        logger.info('rows returned: %s', len(res))
+                    return res
+        except (errors.OperationalError, errors.InterfaceError) as e:
+            if not (retry and is_lost_connection(e)):
+                raise
+            logger.warning('lost database connection, retrying: %s', e)
+
+
+# 每行返回一个tuple，列的顺序与sql中一致，省去为每行构造dict的开销
+async def select_tuple(sql, args, size=None):
+    return await select(sql, args, size, cursors.Cursor)
+
+
+# 流式读取select的结果，默认使用非缓冲的SSDictCursor，每次从服务器取chunk行
+# 适用于结果集很大的查询，内存占用不随结果行数增长
+async def select_iter(sql, args, chunk=1000, cursorclass=cursors.SSDictCursor):
+    log(sql, args)
+
+    async with connection() as conn:
+        async with conn.cursor(cursorclass) as cur:
+            await cur.execute(sql, args or ())
+            count = 0
+            while True:
+                res = await cur.fetchmany(chunk)
+                if not res:
+                    break
+                count += len(res)
+                for r in res:
+                    yield r
 
-            logging.info('rows returned: %s' % len(res))
-            return res
+            logger.info('rows returned: %s', count)
 
 
 # 封装insert、update、delete
@@ -90,38 +190,161 @@ async def select(sql, args, size=None):
 async def execute(sql, args, autocommit=True):
     log(sql, args)
 
-    async with __pool.get() as conn:
-        if not autocommit:
-            await conn.begin()
+    # 只捕获Exception，asyncio.CancelledError等直接向上传递
+    # 被取消时仍处于事务中的连接，归还连接池时会被关闭
+    manual = not autocommit
+    # insert、update、delete不是幂等的，只有确定语句没有到达服务端时才换一个连接重试一次：
+    # 取连接、ping、begin时连接已断开，或者发送语句时报2006
+    # 发送之后才断开（如2013 Lost connection during query）时，语句可能已经提交，不能重试
+    for retry in (True, False):
+        sent = False
+        try:
+            async with connection() as conn:
+                try:
+                    if manual:
+                        await conn.begin()
+                    async with conn.cursor(cursors.DictCursor) as cur:
+                        sent = True
+                        await cur.execute(sql, args)
+                        affected = cur.rowcount
+                    if manual:
+                        await conn.commit()
+                    return affected
+                except Exception as e:
+                    if manual and not is_lost_connection(e):
+                        await conn.rollback()
+                    raise
+        except (errors.OperationalError, errors.InterfaceError) as e:
+            if not (retry and is_lost_connection(e) and (not sent or is_server_gone(e))):
+                raise
+            logger.warning('lost database connection, retrying: %s', e)
+
+
+# 批量执行同一条insert、update、delete语句，args为每一行参数组成的列表
+# 按chunk分批调用executemany，限制单次发送的数据量
+# 驱动只会把insert ... values改写成一条多行insert，一批只需一次网络往返；update、delete仍是每行执行一次
+# 默认所有批次在同一个事务中执行，出错时全部回滚；autocommit为True时每条语句单独提交，
+# 出错时之前的批次已经写入，且不会返回已影响的行数
+async def executemany(sql, args, autocommit=False, chunk=1000):
+    log(sql, args)
 
+    manual = not autocommit
+    async with connection() as conn:
         try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
-                affected = cur.rowcount
-            if not autocommit:
+            if manual:
+                await conn.begin()
+            affected = 0
+            async with conn.cursor(cursors.DictCursor) as cur:
+                for i in range(0, len(args), chunk):
+                    await cur.executemany(sql, args[i:i + chunk])
+                    affected += cur.rowcount
+            if manual:
                 await conn.commit()
-        except BaseException as e:
-            if not autocommit:
+            return affected
+        except Exception as e:
+            if manual and not is_lost_connection(e):
                 await conn.rollback()
             raise
 
-        return affected
+
+# 进程内的查询结果缓存（类似Phalcon的modelsCache），key的第一项总是表名
+# 缓存的是数据库返回的原始行，命中时重新构造Model实例，避免调用者修改缓存内容
+# 只有调用find/findAll时传入cache参数才会使用缓存；缓存只在本进程内、由Model的写操作失效，
+# 其他进程或直接调用execute修改的数据不会使缓存失效，需要通过lifetime限制缓存时间
+# 测试时可将memory_cache_enabled置为False关闭缓存
+memory_cache_enabled = True
+memory_cache_maxsize = 1024
+__cache__ = OrderedDict()
+# 每个表的版本号，表数据变化时加1
+# 查询前记下版本号，查询返回后版本号已变化，说明查询期间表被修改过，结果不再写入缓存
+__generations__ = {}
+
+
+def cache_generation(table):
+    return __generations__.get(table, 0)
+
+
+def cache_get(key):
+    if not memory_cache_enabled:
+        return None
+    entry = __cache__.get(key)
+    if entry is None:
+        return None
+    expires, value = entry
+    if expires is not None and expires < time.monotonic():
+        del __cache__[key]
+        return None
+    # 最近使用的移到末尾，淘汰时从头部删除
+    __cache__.move_to_end(key)
+    return value
+
+
+def cache_set(key, value, lifetime=None, generation=None):
+    if not memory_cache_enabled:
+        return
+    if generation is not None and generation != cache_generation(key[0]):
+        return
+    expires = time.monotonic() + lifetime if lifetime else None
+    __cache__[key] = (expires, value)
+    __cache__.move_to_end(key)
+    while len(__cache__) > memory_cache_maxsize:
+        __cache__.popitem(last=False)
+
+
+# 表中数据发生变化时，删除该表相关的所有缓存
+def cache_invalidate(table):
+    __generations__[table] = cache_generation(table) + 1
+    for key in [k for k in __cache__ if k[0] == table]:
+        del __cache__[key]
 
 
 # 根据输入的参数生成占位符列表
 # 将查询字段计数替换成sql识别的?
 # 如： insert into `user`(`password`,`email`,`name`,`id`) values(?,?,?,?)
 def create_args_string(num):
-    L = []
-    for n in range(num):
-        L.append('?')
-    # 以‘，’为分隔符，将列表合成字符串
-    return (','.join(L))
+    # 直接用字符串乘法生成，不需要循环和中间列表
+    return '?' + ',?' * (num - 1) if num else ''
+
+
+# 为Model子类生成取参数的函数，按字段顺序返回参数列表，替代逐个字段调用getValue/getValueOrDefault
+# withDefault为True时，缺少的字段使用Field的默认值，并写回实例（与getValueOrDefault行为一致）
+# 字段保存在__slots__中，未赋值的字段访问时抛出AttributeError
+def create_packer(funcName, keys, mappings, withDefault):
+    namespace = {}
+    lines = ['def %s(self):' % funcName]
+    for i, k in enumerate(keys):
+        default = mappings[k].default if withDefault else None
+        lines.append('    try:')
+        lines.append('        v%d = self.%s' % (i, k))
+        lines.append('    except AttributeError:')
+        if default is None:
+            lines.append('        v%d = None' % i)
+        else:
+            namespace['_d%d' % i] = default
+            lines.append('        v%d = self.%s = _d%d%s' % (i, k, i, '()' if callable(default) else ''))
+    lines.append('    return [%s]' % ', '.join('v%d' % i for i in range(len(keys))))
+    exec('\n'.join(lines) + '\n', namespace)
+    return namespace[funcName]
+
+
+# 为Model子类生成由查询结果行（tuple）构造实例的函数，keys的顺序与__select__中列的顺序一致
+# 直接按下标给slot赋值，不经过dict和**kw解包
+def create_row_mapper(funcName, keys):
+    lines = ['def %s(cls, row):' % funcName, '    obj = _new(cls)']
+    for i, k in enumerate(keys):
+        lines.append('    obj.%s = row[%d]' % (k, i))
+    lines.append('    return obj')
+    namespace = {'_new': object.__new__}
+    exec('\n'.join(lines) + '\n', namespace)
+    return namespace[funcName]
 
 
 # 定义Field类，负责保存（数据库）表的字段名和字段类型
 class Field(object):
     # 表的字段包含名字、类型、是否为表的主键和默认值
+    # 使用__slots__，实例不再带__dict__，属性访问更快、占用内存更少
+    __slots__ = ('name', 'column_type', 'primary_key', 'default')
+
     def __init__(self, name, column_type, primary_key, default):
         self.name = name
         self.column_type = column_type
@@ -136,26 +359,36 @@ class Field(object):
 # 定义不同类型的衍生Field
 # 表的不同列的字段的类型不一样
 class StringField(Field):
+    __slots__ = ()
+
     def __init__(self, name=None, primary_key=False, default=None, column_type='varchar(100)'):
         super().__init__(name, column_type, primary_key, default)
 
 
 class BooleanField(Field):
+    __slots__ = ()
+
     def __init__(self, name=None, default=False):
         super().__init__(name, 'boolean', False, default)
 
 
 class IntegerField(Field):
+    __slots__ = ()
+
     def __init__(self, name=None, primary_key=False, default=0):
         super().__init__(name, 'bigint', primary_key, default)
 
 
 class FloatField(Field):
+    __slots__ = ()
+
     def __init__(self, name=None, primary_key=False, default=0.0):
         super().__init__(name, 'real', primary_key, default)
 
 
 class TextField(Field):
+    __slots__ = ()
+
     def __init__(self, name=None, default=None):
         super().__init__(name, 'text', False, default)
 
@@ -183,7 +416,7 @@ class ModelMetaClass(type):
 
         # 获取table名称
         tableName = attrs.get('__table__', None) or name
-        logging.info('found model: %s(table: %s' % (name, tableName))
+        logger.info('found model: %s(table: %s', name, tableName)
 
         # 获取Field和主键名
         mappings = dict()
@@ -193,7 +426,7 @@ class ModelMetaClass(type):
             # Field属性
             if isinstance(v, Field):
                 # 此处打印的k是类的一个属性，v是这个属性在数据库中对应的Field列表属性
-                logging.info(' found mapping: %s==>%s' % (k, v))
+                logger.info(' found mapping: %s==>%s', k, v)
                 mappings[k] = v
 
                 # 找到主键
@@ -215,8 +448,10 @@ class ModelMetaClass(type):
         for k in mappings.keys():
             attrs.pop(k)
 
-        # 保存除主键外的属性,名为``（运算出字符串）列表形式
-        escaped_fields = list(map(lambda f: '`%s`' % f, fields))
+        # 每个属性对应的列名只计算一次：Field指定了name时使用name，否则使用属性名
+        # 保存除主键外的列名,名为``（运算出字符串）列表形式
+        escaped_fields = ['`%s`' % (mappings[f].name or f) for f in fields]
+        pkColumn = mappings[primaryKey].name or primaryKey
 
         # 保存属性和列的映射关系
         attrs['__mappings__'] = mappings
@@ -226,15 +461,31 @@ class ModelMetaClass(type):
         attrs['__primary_key__'] = primaryKey
         # 保存除主键外的属性名
         attrs['__fields__'] = fields
+        # 每个字段对应一个slot，实例不再需要dict保存数据
+        attrs['__slots__'] = tuple(fields) + (primaryKey,)
 
         # 构造默认的select、insert、update、delete语句
         # ``反引号功能同repr()
-        attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ','.join(escaped_fields), tableName)
+        attrs['__select__'] = 'select `%s`, %s from `%s`' % (pkColumn, ','.join(escaped_fields), tableName)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values(%s)' % (
-            tableName, ','.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
-        attrs['__update__'] = 'update `%s` set %s where `%s` = >' % (
-            tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
-        attrs['__delete__'] = 'delete from `%s` where `%s` = ?' % (tableName, primaryKey)
+            tableName, ','.join(escaped_fields), pkColumn, create_args_string(len(escaped_fields) + 1))
+        attrs['__update__'] = 'update `%s` set %s where `%s` = ?' % (
+            tableName, ', '.join(['%s=?' % f for f in escaped_fields]), pkColumn)
+        attrs['__delete__'] = 'delete from `%s` where `%s` = ?' % (tableName, pkColumn)
+        # 按主键查询、计数查询的语句在创建类时就拼好，避免每次查询都重新拼接字符串
+        attrs['__select_by_pk__'] = '%s where `%s` = ?' % (attrs['__select__'], pkColumn)
+        attrs['__count_tmpl__'] = 'select %%s _num_ from `%s`' % tableName
+
+        # 生成insert、update、delete语句的取参数函数
+        attrs['_pack_insert'] = create_packer('_pack_insert', fields + [primaryKey], mappings, True)
+        attrs['_pack_update'] = create_packer('_pack_update', fields + [primaryKey], mappings, False)
+        attrs['_pack_pk'] = create_packer('_pack_pk', [primaryKey], mappings, False)
+        # 生成由select结果行构造实例的函数
+        attrs['_from_row'] = classmethod(create_row_mapper('_from_row', [primaryKey] + fields))
+
+        # 预先把占位符?替换成mysql驱动使用的%s，查询时直接使用
+        for k in ('__select__', '__insert__', '__update__', '__delete__', '__select_by_pk__'):
+            attrs['%s_pymysql__' % k[:-2]] = attrs[k].replace('?', '%s')
 
         return type.__new__(cls, name, bases, attrs)
 
@@ -244,43 +495,75 @@ class ModelMetaClass(type):
 # Model类可以看做是对所有数据库表操作的基本定义的映射
 
 # 基于字段查询形式
-# Model从dict继承，拥有字典的所有功能，懂事实现特殊方法__getattr__和__setattr__，能够实现属性操作
+# 每个子类的字段由元类生成__slots__保存，实例直接通过属性访问字段，没有dict的哈希表开销
 # 实现数据库操作的所有方法，定义为class方法（类方法），所有继承自Model都具有数据库操作方法
-class Model(dict, metaclass=ModelMetaClass):
-    def __index__(self, **kw):
-        super(Model, self).__init__(**kw)
+class Model(metaclass=ModelMetaClass):
+    __slots__ = ()
 
-    def __getattr__(self, key):
-        try:
-            return self[key]
-        except KeyError:
-            raise AttributeError(r'"Model" object has no attribute: %s' % key)
-
-    def __setattr__(self, key, value):
-        self[key] = value
+    def __init__(self, **kw):
+        for k, v in kw.items():
+            setattr(self, k, v)
 
     def getValue(self, key):
         # 内建函数getattr会自动处理
         return getattr(self, key, None)
 
     def getValueOrDefault(self, key):
-        value = getattr(self, key, None)
-        if not value:
-            field = self.__mappings__[key]
-            if filter.default is not None:
-                value = field.default() if callable(field.default) else field.default
-                logging.debug('using default value for %s:%s' % (key, str(value)))
-                setattr(self, key, value)
+        # 只有字段未赋值时才使用默认值，0、''、False都是合法的值
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            pass
+        field = self.__mappings__[key]
+        if field.default is None:
+            return None
+        value = field.default() if callable(field.default) else field.default
+        logger.debug('using default value for %s:%s', key, value)
+        setattr(self, key, value)
         return value
 
+    # 缓存findNumber的sql模板，key为(cls, selectField, where)
+    @classmethod
+    @functools.lru_cache(maxsize=128)
+    def _count_sql(cls, selectField, where=None):
+        sql = cls.__count_tmpl__ % selectField
+        if where:
+            sql = '%s where %s' % (sql, where.replace('?', '%s'))
+        return sql
+
     # 类方法有类变量cls传入，从而可以用cls做一些相关的处理。 并且有子类继承时，调用该类方法时，传入的类变量cls是子类，而非父类
     @classmethod
     async def findAll(cls, where=None, args=None, **kw):
         '''find objects by where clause'''
-        sql = [cls.__select__]
+        # cache={'key': ..., 'lifetime': ...}，lifetime单位为秒，不指定则直到表数据变化才失效
+        cache = kw.get('cache', None)
+        if cache:
+            cacheKey = (cls.__table__, 'findAll', cache['key'])
+            res = cache_get(cacheKey)
+            if res is not None:
+                return [cls._from_row(r) for r in res]
+            generation = cache_generation(cls.__table__)
+
+        res = await select_tuple(*cls._findAllSql(where, args, **kw))
+        if cache:
+            cache_set(cacheKey, res, cache.get('lifetime', None), generation)
+        return [cls._from_row(r) for r in res]
+
+    @classmethod
+    async def iter_all(cls, where=None, args=None, chunk=1000, **kw):
+        '''iterate objects by where clause without loading all rows into memory'''
+        sql, args = cls._findAllSql(where, args, **kw)
+        async for r in select_iter(sql, args, chunk, cursors.SSCursor):
+            yield cls._from_row(r)
+
+    # 根据where、orderBy、limit拼接findAll和iter_all使用的sql语句，返回(sql, args)
+    @classmethod
+    def _findAllSql(cls, where=None, args=None, **kw):
+        sql = [cls.__select_pymysql__]
         if where:
             sql.append('where')
-            sql.append(where)
+            # where子句由调用者传入，仍使用?作为占位符，只转换这一小段
+            sql.append(where.replace('?', '%s'))
         if args is None:
             args = []
 
@@ -293,59 +576,117 @@ class Model(dict, metaclass=ModelMetaClass):
         if limit is not None:
             sql.append('limit')
             if isinstance(limit, int):
-                sql.append('?')
+                sql.append('%s')
                 args.append(limit)
             elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
+                sql.append('%s, %s')
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        res = await select(' '.join(sql), args)
-        return [cls(**r) for r in res]
+        return ' '.join(sql), args
 
     @classmethod
     async def findNumber(cls, selectField, where=None, args=None):
         '''find number by select and where'''
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        res = await select(' '.join(sql), args, 1)
+        res = await select_tuple(cls._count_sql(selectField, where), args, 1)
         if len(res) == 0:
             return None
-        return res[0]['_num_']
+        return res[0][0]
 
     @classmethod
-    async def find(cls, pk):
+    async def find(cls, pk, cache=None):
         '''find object by primary key'''
-        res = await select('%s where `%s` = ?' % (cls.__select__, cls.__primary_key__), [pk], 1)
-        if len(res) == 0:
-            return None
-        return cls(**res[0])
-
+        # cache={'lifetime': ...}，与findAll相同，key为主键；不传cache时不使用缓存
+        if not cache:
+            res = await select_tuple(cls.__select_by_pk_pymysql__, [pk], 1)
+            if len(res) == 0:
+                return None
+            return cls._from_row(res[0])
+
+        cacheKey = (cls.__table__, pk)
+        row = cache_get(cacheKey)
+        if row is None:
+            generation = cache_generation(cls.__table__)
+            res = await select_tuple(cls.__select_by_pk_pymysql__, [pk], 1)
+            if len(res) == 0:
+                return None
+            row = res[0]
+            cache_set(cacheKey, row, cache.get('lifetime', None), generation)
+        return cls._from_row(row)
+
+    # 写操作失败时数据也可能已经改变，所以无论成功与否都要使缓存失效
     async def save(self):
-        args = list(map(self.getValueOrDefault, self.__fields__))
-        args.append(self.getValueOrDefault(self.__primary_key__))
-        rows = await execute(self.__insert__, args)
+        args = self._pack_insert()
+        try:
+            rows = await execute(self.__insert_pymysql__, args)
+        finally:
+            cache_invalidate(self.__table__)
         if rows != 1:
-            logging.warning('failed to insert record: affected rows: %s' % rows)
+            logger.warning('failed to insert record: affected rows: %s', rows)
 
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
-        args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        args = self._pack_update()
+        try:
+            rows = await execute(self.__update_pymysql__, args)
+        finally:
+            cache_invalidate(self.__table__)
         if rows != 1:
-            logging.warning('failed to update by primary key: affected rows: %s' % rows)
+            logger.warning('failed to update by primary key: affected rows: %s', rows)
 
     async def remove(self):
-        args = [self.getValue(self.__primary_key__)]
-        rows = await execute(self.__delete__, args)
+        args = self._pack_pk()
+        try:
+            rows = await execute(self.__delete_pymysql__, args)
+        finally:
+            cache_invalidate(self.__table__)
         if rows != 1:
-            logging.warning('failed to remove by primary key: affected rows: %s' % rows)
+            logger.warning('failed to remove by primary key: affected rows: %s', rows)
+
+    # 批量保存、更新、删除，所有行共用一条预先生成的sql语句，默认在一个事务中执行
+    @classmethod
+    async def save_many(cls, objs, autocommit=False):
+        args = [obj._pack_insert() for obj in objs]
+        if not args:
+            return 0
+        try:
+            rows = await executemany(cls.__insert_pymysql__, args, autocommit)
+        finally:
+            cache_invalidate(cls.__table__)
+        if rows != len(args):
+            logger.warning('failed to insert records: affected rows: %s of %s', rows, len(args))
+        return rows
+
+    @classmethod
+    async def update_many(cls, objs, autocommit=False):
+        args = [obj._pack_update() for obj in objs]
+        if not args:
+            return 0
+        try:
+            rows = await executemany(cls.__update_pymysql__, args, autocommit)
+        finally:
+            cache_invalidate(cls.__table__)
+        if rows != len(args):
+            logger.warning('failed to update by primary key: affected rows: %s of %s', rows, len(args))
+        return rows
+
+    @classmethod
+    async def remove_many(cls, objs, autocommit=False):
+        args = [obj._pack_pk() for obj in objs]
+        if not args:
+            return 0
+        try:
+            rows = await executemany(cls.__delete_pymysql__, args, autocommit)
+        finally:
+            cache_invalidate(cls.__table__)
+        if rows != len(args):
+            logger.warning('failed to remove by primary key: affected rows: %s of %s', rows, len(args))
+        return rows
 
 
 if __name__ == '__main__':  # 一个类自带前后都有双下划线的方法， 在子类继承该类的时候，这些方法会自动调用，比如__init__
-    class User(Model):  # 虽然User类乍看之下没有参数传入，但实际上，User类继承自Model类，Model类又继承自dict类，所以User类的实例可以传入关键字参数**kw
+    import sys
+
+    class User(Model):  # 虽然User类乍看之下没有参数传入，但实际上，User类继承自Model类，Model.__init__接收关键字参数**kw，所以User类的实例可以传入关键字参数**kw
         id = IntegerField('id', primary_key=True)
         name = StringField('name')
 